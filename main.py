@@ -1,4 +1,5 @@
 import aiohttp
+import aiolimiter
 import argparse
 import asyncio
 import logging
@@ -6,10 +7,16 @@ import os
 import sanic
 import sanic.response
 import selenium.webdriver
+import selenium.webdriver.support.expected_conditions
+import selenium.webdriver.support.ui
 import telegram
 import time
+import urllib.parse
+import yarl
 
 EIKAMET_MAIN_PAGE = "https://e-ikamet.goc.gov.tr/Ikamet/DevamEdenBasvuruGiris"
+RUCAPTCHA_IN_URL = "https://rucaptcha.com/in.php"
+RUCAPTCHA_RES_URL = "https://rucaptcha.com/res.php"
 APPLICATION_FIELD_ID = "basvuruNo"
 EMAIL_FIELD_ID = "ePosta"
 PASSPORT_FIELD_ID = "pasaportBelgeNo"
@@ -20,8 +27,15 @@ LOADING_TEXT_CSS_SELECTOR = "span.loading-text"
 
 RESULT_ELEMENT_CSS_SELECTOR = "span.noty_text"
 
+# Only third-party trackers, the page's own images and fonts render the captcha and its refresh button
+BLOCKED_URL_PATTERNS = [
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+]
+
 WRONG_CAPTCHA_ERROR_MESSAGE = "Image verification fails."
 REFRESH_CAPTCHA_BUTTON_TITLE = "Click to refresh the image verification code."
+REFRESH_CAPTCHA_BUTTON_CSS_SELECTOR = f"[title^='{REFRESH_CAPTCHA_BUTTON_TITLE}']"
 
 
 APPLICATION_NUMBER = os.environ["APPLICATION_NUMBER"]
@@ -33,6 +47,20 @@ TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 
 TELEGRAM_BOT_CHAT_ID = os.environ["TELEGRAM_BOT_CHAT_ID"]
 
+RUCAPTCHA_IN_FIELDS = {
+    'key': RUCAPTCHA_API_KEY,
+    'method': 'post',
+    'numeric': '2',
+    'min_len': '8',
+    'max_len': '8',
+    'language': '2',
+    'json': '1'}
+
+# Everything but the captcha id is fixed, encode it once
+RUCAPTCHA_GET_QUERY = urllib.parse.urlencode({'action': 'get', 'key': RUCAPTCHA_API_KEY, 'json': 1})
+RUCAPTCHA_REPORT_GOOD_QUERY = urllib.parse.urlencode({'action': 'reportgood', 'key': RUCAPTCHA_API_KEY})
+RUCAPTCHA_REPORT_BAD_QUERY = urllib.parse.urlencode({'action': 'reportbad', 'key': RUCAPTCHA_API_KEY})
+
 
 logger = logging.getLogger(__name__)
 
@@ -41,177 +69,387 @@ app.config.REQUEST_TIMEOUT = 600
 app.config.RESPONSE_TIMEOUT = 600
 app.config.KEEP_ALIVE_TIMEOUT = 600
 
+HTTP_CONNECTION_LIMIT = 32
+DRIVER_POOL_SIZE = 2
+
+# Telegram allows about 20 messages per minute to the same chat
+TELEGRAM_CHAT_LIMITER = aiolimiter.AsyncLimiter(max_rate=20, time_period=60)
+
+RESULT_WAIT_TIMEOUT_SECONDS = 15
+
+CAPTCHA_INITIAL_WAIT_SECONDS = 15
+CAPTCHA_POLL_INITIAL_DELAY_SECONDS = 3
+CAPTCHA_POLL_MAX_DELAY_SECONDS = 10
+CAPTCHA_POLL_BACKOFF_FACTOR = 1.5
+CAPTCHA_MAX_POLL_ATTEMPTS = 25
+
 
 class SolveCaptchaException(Exception):
     pass
 
 
 class CaptchaSolver:
-    def __init__(self, captcha_image_base64):
-        self.captcha_image_base64 = captcha_image_base64
+    def __init__(self, session, captcha_image_png):
+        self.session = session
+        self.captcha_image_png = captcha_image_png
         self.captcha_key = None
 
 
     async def solve_captcha(self):
-        async with aiohttp.ClientSession() as session:
-            logger.info("Sending captcha to rucaptcha")
-            async with session.post("http://rucaptcha.com/in.php", data={
-                'key': RUCAPTCHA_API_KEY,
-                'method': 'base64',
-                'body': self.captcha_image_base64,
-                'numeric': 2,
-                'min_len': 8,
-                'max_len': 8,
-                'language': 2,
-                'json': 1}) as captcha_response:
-                captcha_response_text = await captcha_response.text()
-                logger.info(f"Got response from rucaptcha {captcha_response_text}")
-                if not captcha_response.ok:
-                    raise SolveCaptchaException("Got bad error code from RuCaptcha: {captcha_response} {captcha_response_text}")
-                try:
-                    captcha_response_json = await captcha_response.json()
-                except json.JSONDecodeError:
-                    logger.error(f"Could not parse JSON: {captcha_response_text}")
-                    raise SolveCaptchaException(f"Could not parse in.php output JSON response: {captcha_response_text}")
-
-                if captcha_response_json['status'] != 1:
-                    raise SolveCaptchaException(f"Error from RuCaptcha: {captcha_response_json['request']}")
-
-                self.captcha_key = captcha_response_json['request']
-                return await self._wait_for_captcha_output(session)
-
-
-    async def _wait_for_captcha_output(self, session):
-        while True:
+        logger.info("Sending captcha to rucaptcha")
+        form = aiohttp.FormData(RUCAPTCHA_IN_FIELDS)
+        form.add_field('file', self.captcha_image_png, filename='captcha.png', content_type='image/png')
+        async with self.session.post(RUCAPTCHA_IN_URL, data=form) as captcha_response:
+            captcha_response_text = await captcha_response.text()
+            logger.info(f"Got response from rucaptcha {captcha_response_text}")
+            if not captcha_response.ok:
+                raise SolveCaptchaException("Got bad error code from RuCaptcha: {captcha_response} {captcha_response_text}")
+            try:
+                captcha_response_json = await captcha_response.json()
+            except json.JSONDecodeError:
+                logger.error(f"Could not parse JSON: {captcha_response_text}")
+                raise SolveCaptchaException(f"Could not parse in.php output JSON response: {captcha_response_text}")
+
+            if captcha_response_json['status'] != 1:
+                raise SolveCaptchaException(f"Error from RuCaptcha: {captcha_response_json['request']}")
+
+            self.captcha_key = captcha_response_json['request']
+            return await self._wait_for_captcha_output()
+
+
+    def _res_url(self, query):
+        # The query is already encoded, don't let yarl quote it again
+        return yarl.URL(f"{RUCAPTCHA_RES_URL}?{query}&id={urllib.parse.quote_plus(self.captcha_key)}", encoded=True)
+
+
+    async def _wait_for_captcha_output(self):
+        # Captchas are rarely solved in under 15 seconds, don't poll until then
+        await asyncio.sleep(CAPTCHA_INITIAL_WAIT_SECONDS)
+        delay = CAPTCHA_POLL_INITIAL_DELAY_SECONDS
+        for attempt in range(CAPTCHA_MAX_POLL_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(delay)
+                delay = min(delay * CAPTCHA_POLL_BACKOFF_FACTOR, CAPTCHA_POLL_MAX_DELAY_SECONDS)
             logger.info("Waiting for captcha output")
-            await asyncio.sleep(5)
-            async with session.get("http://rucaptcha.com/res.php", params={
-                'action': 'get',
-                'key': RUCAPTCHA_API_KEY,
-                'id': self.captcha_key,
-                'json': 1
-                }) as captcha_output_response:
+            async with self.session.get(self._res_url(RUCAPTCHA_GET_QUERY)) as captcha_output_response:
                 captcha_output_response_text = await captcha_output_response.text()
                 logger.info(f"Captcha output: {captcha_output_response_text}")
                 captcha_output_response = await captcha_output_response.json()
-                if captcha_output_response['request'] == "CAPCHA_NOT_READY":
-                    continue
-                if captcha_output_response['request'].startswith("ERROR") or captcha_output_response['status'] != 1:
-                    raise SolveCaptchaException(f"Got error while solving captcha: {captcha_output_response}")
-                return captcha_output_response['request'].upper()
+            if captcha_output_response['request'] == "CAPCHA_NOT_READY":
+                continue
+            if captcha_output_response['request'].startswith("ERROR") or captcha_output_response['status'] != 1:
+                raise SolveCaptchaException(f"Got error while solving captcha: {captcha_output_response}")
+            return captcha_output_response['request'].upper()
+        raise SolveCaptchaException(f"Captcha {self.captcha_key} was not solved after {CAPTCHA_MAX_POLL_ATTEMPTS} attempts")
 
 
     async def report_good(self):
         assert self.captcha_key is not None
-        async with aiohttp.ClientSession() as session:
-            async with session.get("http://rucaptcha.com/res.php", params={
-                'action': 'reportgood',
-                'key': RUCAPTCHA_API_KEY,
-                'id': self.captcha_key,
-                }) as resp:
-                return resp.status
+        async with self.session.get(self._res_url(RUCAPTCHA_REPORT_GOOD_QUERY)) as resp:
+            return resp.status
 
 
     async def report_bad(self):
         assert self.captcha_key is not None
-        async with aiohttp.ClientSession() as session:
-            async with session.get("http://rucaptcha.com/res.php", params={
-                'action': 'reportbad',
-                'key': RUCAPTCHA_API_KEY,
-                'id': self.captcha_key,
-                }) as resp:
-                return resp.status
+        async with self.session.get(self._res_url(RUCAPTCHA_REPORT_BAD_QUERY)) as resp:
+            return resp.status
+
+
+PREFETCH_ELEMENTS_SCRIPT = """
+return arguments[0].map(([by, value]) =>
+    by === 'id' ? document.getElementById(value) : document.querySelector(value));
+"""
+
+
+class ElementCache:
+    def __init__(self, driver):
+        self.driver = driver
+        self.elements = {}
+
+
+    def prefetch(self, locators):
+        # Resolves all locators in a single round-trip, supports 'id' and 'css selector'
+        found_elements = self.driver.execute_script(PREFETCH_ELEMENTS_SCRIPT, [list(locator) for locator in locators])
+        for locator, element in zip(locators, found_elements):
+            if element is not None:
+                self.elements[locator] = element
+
+
+    def find(self, by, value):
+        if (by, value) not in self.elements:
+            self.elements[(by, value)] = self.driver.find_element(by=by, value=value)
+        return self.elements[(by, value)]
+
+
+    def apply(self, by, value, action):
+        try:
+            return action(self.find(by, value))
+        except selenium.common.exceptions.StaleElementReferenceException:
+            # The page replaced the element, look it up again once
+            del self.elements[(by, value)]
+            return action(self.find(by, value))
 
 
-def fill_element(driver, element_id, element_value):
-    element = driver.find_element(by='id', value=element_id)
+def fill_element(element, element_value):
     element.clear()
     element.click()
     element.send_keys(element_value)
 
 
-async def solve_eikamet_captcha(driver):
+FILL_ELEMENTS_SCRIPT = """
+for (const [elementId, elementValue] of Object.entries(arguments[0])) {
+    const element = document.getElementById(elementId);
+    element.value = elementValue;
+    element.dispatchEvent(new Event('input', {bubbles: true}));
+    element.dispatchEvent(new Event('change', {bubbles: true}));
+}
+"""
+
+
+def fill_elements(driver, values_by_id):
+    # Sets all values in a single round-trip instead of typing into each field
+    driver.execute_script(FILL_ELEMENTS_SCRIPT, values_by_id)
+
+
+def wait_for_result_element(driver):
+    wait = selenium.webdriver.support.ui.WebDriverWait(driver, RESULT_WAIT_TIMEOUT_SECONDS)
+    return wait.until(selenium.webdriver.support.expected_conditions.visibility_of_element_located(
+        ('css selector', RESULT_ELEMENT_CSS_SELECTOR)))
+
+
+def read_result(driver):
+    try:
+        result_value_element = wait_for_result_element(driver)
+    except selenium.common.exceptions.TimeoutException:
+        logger.error("Did not find noty_text element on the page")
+        # Without the result element, fall back to the whole page to see what went wrong
+        return "Unknown status", driver.find_element(by='tag name', value='body').screenshot_as_png
+
+    result_text = result_value_element.text.strip()
+    result_screenshot = None
+    if result_text != WRONG_CAPTCHA_ERROR_MESSAGE:
+        result_screenshot = result_value_element.screenshot_as_png
+    result_value_element.click()
+    return result_text, result_screenshot
+
+
+def submit_captcha(elements, captcha_text):
+    elements.apply('id', CAPTCHA_FIELD_ID, lambda element: fill_element(element, captcha_text))
+    elements.apply('css selector', BUTTON_CSS_SELECTOR, lambda element: element.click())
+
+
+def open_application_form(driver):
+    driver.get(EIKAMET_MAIN_PAGE)
+    fill_elements(driver, {
+        APPLICATION_FIELD_ID: APPLICATION_NUMBER,
+        EMAIL_FIELD_ID: EMAIL,
+        PASSPORT_FIELD_ID: PASSPORT_NUMBER,
+        })
+    elements = ElementCache(driver)
+    elements.prefetch([
+        ('id', CAPTCHA_IMAGE_FIELD_ID),
+        ('id', CAPTCHA_FIELD_ID),
+        ('css selector', BUTTON_CSS_SELECTOR),
+        ('css selector', REFRESH_CAPTCHA_BUTTON_CSS_SELECTOR),
+        ])
+    return elements
+
+
+async def run_in_thread(func, *args):
+    # Selenium calls block on chromedriver, keep them off the event loop.
+    # asyncio.to_thread is not available on Python 3.8.
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def solve_eikamet_captcha(session, driver, elements):
     bad_captcha_attempts = 0
     while True:
-        captcha_image_element = driver.find_element(by='id', value=CAPTCHA_IMAGE_FIELD_ID)
-        captcha_image_base64 = captcha_image_element.screenshot_as_base64
+        captcha_image_png = await run_in_thread(
+            elements.apply, 'id', CAPTCHA_IMAGE_FIELD_ID, lambda element: element.screenshot_as_png)
 
-        captcha_solver = CaptchaSolver(captcha_image_base64)
+        captcha_solver = CaptchaSolver(session, captcha_image_png)
         try:
             ikamet_captcha_text = await captcha_solver.solve_captcha()
         except SolveCaptchaException as error:
             if bad_captcha_attempts > 2:
                 raise
             logger.error(f"Got error while solving captcha: {error}")
-            refresh_button = driver.find_element(by='css selector', value=f"[title^='{REFRESH_CAPTCHA_BUTTON_TITLE}']")
-            refresh_button.click()
+            await run_in_thread(
+                elements.apply, 'css selector', REFRESH_CAPTCHA_BUTTON_CSS_SELECTOR, lambda element: element.click())
             await asyncio.sleep(0.5) # Wait for refresh
             bad_captcha_attempts += 1
             continue
 
         logger.info(f"Solved captcha as {ikamet_captcha_text}")
 
-        fill_element(driver, CAPTCHA_FIELD_ID, ikamet_captcha_text)
+        await run_in_thread(submit_captcha, elements, ikamet_captcha_text)
+
+        result_text, result_screenshot = await run_in_thread(read_result, driver)
+        if result_text == WRONG_CAPTCHA_ERROR_MESSAGE:
+            await captcha_solver.report_bad()
+            continue
+
+        await captcha_solver.report_good()
+        return result_text, result_screenshot
+
+
+async def get_ikamet_status(session, driver):
+    logger.info("Getting e-ikamet status")
+    elements = await run_in_thread(open_application_form, driver)
+    result, result_screenshot = await solve_eikamet_captcha(session, driver, elements)
+    logger.info(f"Result output: {result}")
+    return result, result_screenshot
+
+
+async def send_rate_limited(send, **kwargs):
+    async with TELEGRAM_CHAT_LIMITER:
+        return await send(chat_id=TELEGRAM_BOT_CHAT_ID, **kwargs)
+
 
-        login_button = driver.find_element(by='css selector', value=BUTTON_CSS_SELECTOR)
-        login_button.click()
+async def send_message_to_tg(bot, message, screenshot):
+    # Runs as a background task, so nobody else would see the error
+    try:
+        # Initialized on first use so Telegram problems can't stop the server from starting, no-op afterwards
+        await bot.initialize()
+        # One captioned photo keeps the text next to its screenshot and costs a single API call
+        await send_rate_limited(bot.send_photo, photo=screenshot, caption=message)
+    except Exception:
+        logger.exception("Could not send e-ikamet status to Telegram")
 
-        # Wait for results to load
-        await asyncio.sleep(5)
 
-        full_screenshot = driver.find_element(by='tag name', value='body').screenshot_as_png
+def create_driver():
+    options = selenium.webdriver.ChromeOptions()
+    options.headless = True
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--window-size=1280,2000")
+    driver = selenium.webdriver.Chrome(options=options)
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+    return driver
+
+
+class DriverPool:
+    def __init__(self, size):
+        self.size = size
+        self.drivers = set()
+        # Holds idle drivers, None marks a slot whose driver still has to be created
+        self.idle_drivers = asyncio.Queue()
+
+
+    async def start(self):
+        for _ in range(self.size):
+            self.idle_drivers.put_nowait(await self._create_driver())
+
+
+    async def acquire(self):
+        driver = await self.idle_drivers.get()
+        if driver is None:
+            creation = asyncio.ensure_future(self._create_driver())
+            try:
+                driver = await asyncio.shield(creation)
+            except asyncio.CancelledError:
+                # The driver still gets started in its worker thread, hand it to the pool once it is up
+                creation.add_done_callback(self._return_created_driver)
+                raise
+            if driver is None:
+                self.idle_drivers.put_nowait(None)
+                raise RuntimeError("Could not start Chrome driver")
+        return driver
 
+
+    def _return_created_driver(self, creation):
+        self.idle_drivers.put_nowait(None if creation.cancelled() else creation.result())
+
+
+    async def release(self, driver):
         try:
-            result_value_element = driver.find_element(by='css selector', value=RESULT_ELEMENT_CSS_SELECTOR)
-        except selenium.common.exceptions.NoSuchElementException:
-            logger.error("Did not find noty_text element on the page")
-            result_text = "Unknown status"
+            await run_in_thread(driver.delete_all_cookies)
+        except Exception:
+            logger.exception("Chrome driver is broken, replacing it")
+            await self.replace(driver)
         else:
-            result_text = result_value_element.text.strip()
-            result_value_element.click()
-            if result_text == WRONG_CAPTCHA_ERROR_MESSAGE:
-                await captcha_solver.report_bad()
-                continue
+            self.idle_drivers.put_nowait(driver)
 
-        await captcha_solver.report_good()
-        return result_text, full_screenshot
 
+    async def replace(self, driver):
+        await self._quit_driver(driver)
+        self.idle_drivers.put_nowait(await self._create_driver())
 
-def window_resize(driver):
-    required_width = driver.execute_script('return document.body.parentNode.scrollWidth')
-    required_height = driver.execute_script('return document.body.parentNode.scrollHeight')
-    driver.set_window_size(required_width, required_height + 100)
 
+    async def close(self):
+        for driver in list(self.drivers):
+            await self._quit_driver(driver)
 
-async def get_ikamet_status(driver):
-    logger.info("Getting e-ikamet status")
-    driver.get(EIKAMET_MAIN_PAGE)
-    window_resize(driver)
-    fill_element(driver, APPLICATION_FIELD_ID, APPLICATION_NUMBER)
-    fill_element(driver, EMAIL_FIELD_ID, EMAIL)
-    fill_element(driver, PASSPORT_FIELD_ID, PASSPORT_NUMBER)
 
-    result, result_screenshot = await solve_eikamet_captcha(driver)
-    logger.info(f"Result output: {result}")
-    return result, result_screenshot
+    async def _create_driver(self):
+        try:
+            driver = await run_in_thread(create_driver)
+        except Exception:
+            logger.exception("Could not start Chrome driver")
+            return None
+        self.drivers.add(driver)
+        return driver
+
+
+    async def _quit_driver(self, driver):
+        self.drivers.discard(driver)
+        try:
+            await run_in_thread(driver.quit)
+        except Exception:
+            logger.exception("Could not quit Chrome driver")
+
+
+@app.before_server_start
+async def create_http_session(app, loop):
+    connector = aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, ttl_dns_cache=300, keepalive_timeout=75)
+    app.ctx.session = aiohttp.ClientSession(connector=connector)
+
+
+@app.before_server_stop
+async def close_http_session(app, loop):
+    await app.ctx.session.close()
+
+
+@app.before_server_start
+async def create_telegram_bot(app, loop):
+    app.ctx.bot = telegram.Bot(TELEGRAM_BOT_TOKEN)
 
 
-async def send_message_to_tg(message, screenshot):
-    bot = telegram.Bot(TELEGRAM_BOT_TOKEN)
-    async with bot:
-        await bot.send_message(chat_id=TELEGRAM_BOT_CHAT_ID, text=message)
-        await bot.send_photo(chat_id=TELEGRAM_BOT_CHAT_ID, photo=screenshot)
+@app.before_server_stop
+async def close_telegram_bot(app, loop):
+    await app.ctx.bot.shutdown()
+
+
+@app.before_server_start
+async def create_driver_pool(app, loop):
+    app.ctx.driver_pool = DriverPool(DRIVER_POOL_SIZE)
+    await app.ctx.driver_pool.start()
+
+
+@app.before_server_stop
+async def close_driver_pool(app, loop):
+    await app.ctx.driver_pool.close()
 
 
 @app.route("/", methods=["GET", "POST"])
 async def handle_request(request):
-    options = selenium.webdriver.ChromeOptions()
-    options.headless = True
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    with selenium.webdriver.Chrome(options=options) as driver:
-        ikamet_status, screenshot = await get_ikamet_status(driver)
-        await send_message_to_tg(ikamet_status, screenshot)
+    driver_pool = request.app.ctx.driver_pool
+    driver = await driver_pool.acquire()
+    cancelled = False
+    try:
+        ikamet_status, screenshot = await get_ikamet_status(request.app.ctx.session, driver)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if cancelled:
+            # Cancelling does not stop the Selenium call running in a worker thread,
+            # so this driver must not be handed to the next request
+            await asyncio.shield(driver_pool.replace(driver))
+        else:
+            await asyncio.shield(driver_pool.release(driver))
+    request.app.add_task(send_message_to_tg(request.app.ctx.bot, ikamet_status, screenshot))
     return sanic.response.text(ikamet_status)
 
 